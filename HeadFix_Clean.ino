@@ -98,7 +98,7 @@ void homeActuator() {
 }
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(115200);
   Serial.setTimeout(100);
 
   // configure pins
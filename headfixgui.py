@@ -1,18 +1,17 @@
 import tkinter as tk
 from tkinter import filedialog
 import serial
-import threading
+from serial.threaded import ReaderThread, LineReader
+import queue
 import time
 import csv
 
 # open the serial port to talk to the Arduino
 # you might need to change 'COM7' to match your system
-ser = serial.Serial('COM7', 9600, timeout=0.1)
+ser = serial.Serial('COM7', 115200, timeout=0.05, write_timeout=0.1)
 
 # --- basic flags and default parameters ---
 flush_active = False                 # true when water flushing is active
-free_reward_enabled = True           # whether free rewards are allowed
-habituation_enabled = False          # whether habituation mode is turned on
 struggle_threshold = 350.0           # default struggle threshold in grams
 fix_duration = 7                     # default fixation duration in seconds
 fix_delay = 1                        # how long to wait before another fixation is allowed
@@ -21,82 +20,154 @@ reward_buffer = 1000                 # time the animal must be fixated before re
 
 # store total counts for the session
 totals = {"time": 0, "fix": 0, "escape": 0, "timeup": 0, "struggle": 0, "reward": 0}
+# table columns in the order the Arduino sends them in an EVENT line
+column_keys = ["time", "fix", "escape", "timeup", "struggle", "reward"]
+# how each total is shown in the table
+total_formats = {k: "{}" for k in column_keys}
+total_formats["time"] = "{:.1f}"
+# what the totals row currently shows, so we only redraw labels that changed
+shown_totals = {k: "0" for k in totals}
+# one row per trial event: (seconds into session, duration, fix, escape, timeup, struggle, reward)
+trial_log = []
 
 # timing control for the session
-session_start_time = None            # when the session started
+session_start_mono = None            # when the session started, on the monotonic clock
 timer_running = False                # whether the timer is currently counting
+timer_job = None                     # after() id of the next timer tick, if one is scheduled
+
+# the serial thread puts (kind, payload) here and the GUI thread handles them,
+# since tkinter widgets should only be touched from the main thread
+event_q = queue.Queue()
+
+# console log settings: keep at most LOG_CAP lines so the box doesn't slow down over a long session
+LOG_CAP = 2000
+log_count = 0                        # how many lines are in the console box right now
+scroll_pending = None                # after() id for the next scroll-to-bottom, if one is scheduled
+
+# the last second we formatted a timestamp for, and the text we got
+last_stamp = [0, ""]
+
+# returns the HH:MM:SS for now, only calling strftime once per second
+def log_timestamp():
+    sec = int(time.time())
+    if sec != last_stamp[0]:
+        last_stamp[:] = [sec, time.strftime('%H:%M:%S', time.localtime(sec))]
+    return last_stamp[1]
+
+# scrolls the console to the newest line
+def scroll_console():
+    global scroll_pending
+    scroll_pending = None
+    console_box.see(tk.END)
 
 # this adds a line to the console log box on the GUI
 def add_console_log(msg):
-    console_box.insert(tk.END, f"[{time.strftime('%H:%M:%S')}] {msg}\n")
-    console_box.see(tk.END)
+    global log_count, scroll_pending
+    console_box.insert(tk.END, f"[{log_timestamp()}] {msg}\n")
+    log_count += 1
+    # drop the oldest lines once we go over the cap
+    if log_count > LOG_CAP:
+        console_box.delete('1.0', f'{log_count - LOG_CAP + 1}.0')
+        log_count = LOG_CAP
+    # scroll at most every 100 ms instead of on every line
+    if scroll_pending is None:
+        scroll_pending = root.after(100, scroll_console)
+
+# writes one whole command to the Arduino in a single write
+# commands can't share a write because the Arduino throws away anything
+# that arrives along with a command
+# if the port stops accepting data we log it instead of freezing the GUI
+def send_command(data):
+    try:
+        ser.write(data)
+    except serial.SerialTimeoutException:
+        add_console_log("Serial write timeout")
 
 # toggles water flushing mode
 def toggle_flush():
     global flush_active
     flush_active = not flush_active
     flush_button.config(text="Stop Flushing" if flush_active else "Flush Water")
-    ser.write(b'W' if flush_active else b'w')  # tell Arduino to start/stop flushing
+    send_command(b'W' if flush_active else b'w')  # tell Arduino to start/stop flushing
     add_console_log(f"Flush toggled: {'ON' if flush_active else 'OFF'}")
 
 # toggles free reward mode (rewards given even if not fixated)
+# the checkbox has already updated free_reward_var by the time this runs
 def toggle_free_reward():
-    global free_reward_enabled
-    free_reward_enabled = not free_reward_enabled
-    ser.write(b'M1' if free_reward_enabled else b'M0')
-    add_console_log(f"Free reward {'ENABLED' if free_reward_enabled else 'DISABLED'}")
+    enabled = free_reward_var.get()
+    send_command(b'M1' if enabled else b'M0')
+    add_console_log(f"Free reward {'ENABLED' if enabled else 'DISABLED'}")
 
 # toggles habituation mode (after 25 rewards actuator moves back one level)
 def toggle_habituation():
-    global habituation_enabled
-    habituation_enabled = not habituation_enabled
-    ser.write(b'H1' if habituation_enabled else b'H0')
-    add_console_log(f"Habituation Mode {'ENABLED' if habituation_enabled else 'DISABLED'}")
+    enabled = habituation_var.get()
+    send_command(b'H1' if enabled else b'H0')
+    add_console_log(f"Habituation Mode {'ENABLED' if enabled else 'DISABLED'}")
 
 # helper function for toggling actuator buttons
 def toggle_button(button, state_var, command_on, command_off, label):
     state_var[0] = not state_var[0]
-    ser.write(command_on if state_var[0] else command_off)
+    send_command(command_on if state_var[0] else command_off)
     button.config(bg="#4CAF50" if state_var[0] else "#e0e0e0")
     add_console_log(f"{label} {'START' if state_var[0] else 'STOP'}")
 
-# sends a value to Arduino (for parameters like fix delay, reward buffer, etc.)
+# parameter values waiting to be sent, keyed by command letter: (value to send, label, value typed)
+pending_params = {}
+
+# sends the latest pending value for one parameter to the Arduino
 # we make sure to send command + value together in one go to avoid bugs
-def send_value(entry, command, label, multiplier=1):
+def flush_param(command):
+    val, label, shown = pending_params.pop(command)
+    send_command(f"{command}{val}\n".encode())
+    add_console_log(f"{label} set to {shown}")
+
+# queues a parameter value to send to the Arduino
+# clicks within 50 ms of each other only send the last value
+def queue_param(command, val, label, shown):
+    if command not in pending_params:
+        root.after(50, flush_param, command)
+    pending_params[command] = (val, label, shown)
+
+# sends a whole-number parameter (millisecond values like escape/reward buffer)
+def send_int(entry, command, label):
     try:
-        val = float(entry.get())
-        cmd = command.decode()  # convert b'X' to 'X'
-        ser.write(f"{cmd}{int(val*multiplier)}\n".encode())
-        add_console_log(f"{label} set to {val}")
+        val = int(entry.get())
     except ValueError:
         add_console_log(f"Invalid input for {label}")
+        return
+    queue_param(command, val, label, val)
+
+# sends a parameter typed with decimals (threshold, or seconds converted to ms)
+# the Arduino only reads whole numbers, so the scaled value is rounded to the nearest one
+def send_float(entry, command, label, multiplier=1):
+    try:
+        val = float(entry.get())
+        scaled = round(val*multiplier)  # nan/inf can't become an int, so this is checked too
+    except (ValueError, OverflowError):
+        add_console_log(f"Invalid input for {label}")
+        return
+    queue_param(command, scaled, label, val)
 
 # individual helper functions for each parameter
-def send_threshold(): send_value(threshold_entry, b'T', "Struggle Threshold")
-def send_fix_duration(): send_value(fix_duration_entry, b'X', "Fix Duration", 1000)
-def send_fix_delay(): send_value(fix_delay_entry, b'Y', "Fix Delay", 1000)
-def send_escape_buffer(): send_value(escape_buffer_entry, b'Z', "Escape Buffer")
-def send_reward_buffer(): send_value(reward_buffer_entry, b'Q', "Reward Buffer")
+def send_threshold(): send_float(threshold_entry, 'T', "Struggle Threshold")
+def send_fix_duration(): send_float(fix_duration_entry, 'X', "Fix Duration", 1000)
+def send_fix_delay(): send_float(fix_delay_entry, 'Y', "Fix Delay", 1000)
+def send_escape_buffer(): send_int(escape_buffer_entry, 'Z', "Escape Buffer")
+def send_reward_buffer(): send_int(reward_buffer_entry, 'Q', "Reward Buffer")
 
 # updates the data table when new trial data is received
 def update_table(event_data):
-    duration, fix, escape, timeup, struggle, reward = event_data
-    for i, val in enumerate(event_data):
-        table_labels[2][i].config(text=str(val))
-    # add new values to totals
-    totals["time"] += duration
-    totals["fix"] += fix
-    totals["escape"] += escape
-    totals["timeup"] += timeup
-    totals["struggle"] += struggle
-    totals["reward"] += reward
-    # update table display
-    table_labels[1][0].config(text=f"{totals['time']:.1f}")
-    table_labels[1][1].config(text=str(totals["fix"]))
-    table_labels[1][2].config(text=str(totals["escape"]))
-    table_labels[1][3].config(text=str(totals["timeup"]))
-    table_labels[1][4].config(text=str(totals["struggle"]))
-    table_labels[1][5].config(text=str(totals["reward"]))
+    # keep every trial so the whole session can be saved later
+    session_sec = round(time.monotonic() - session_start_mono, 1) if session_start_mono else 0
+    trial_log.append((session_sec, *event_data))
+    for key, val in zip(column_keys, event_data):
+        table_labels["current"][key].config(text=str(val))
+        # add new value to totals and update the display (skip labels whose text hasn't changed)
+        totals[key] += val
+        text = total_formats[key].format(totals[key])
+        if shown_totals[key] != text:
+            table_labels["totals"][key].config(text=text)
+            shown_totals[key] = text
 
 # saves data to a CSV file
 def save_data_to_file():
@@ -115,89 +186,140 @@ def save_data_to_file():
 
     with open(file_path, mode='w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(["Time(s)", "Fix", "Escape", "TimeUp", "Struggle", "Reward"])
+        writer.writerow(["Session Time(s)", "Time(s)", "Fix", "Escape", "TimeUp", "Struggle", "Reward"])
+        writer.writerows(trial_log)
+        # last row has the session totals
         writer.writerow([
-            table_labels[1][0].cget("text"),
-            table_labels[1][1].cget("text"),
-            table_labels[1][2].cget("text"),
-            table_labels[1][3].cget("text"),
-            table_labels[1][4].cget("text"),
-            table_labels[1][5].cget("text")
+            "Total", totals["time"], totals["fix"], totals["escape"],
+            totals["timeup"], totals["struggle"], totals["reward"]
         ])
     add_console_log(f"Data saved to {file_path}")
 
-# updates the session timer every second
+# updates the session timer every second while a session is running
 def update_session_timer():
-    if session_start_time and timer_running:
-        elapsed = int(time.time() - session_start_time)
-        hours = elapsed // 3600
-        minutes = (elapsed % 3600) // 60
-        seconds = elapsed % 60
-        session_timer_label.config(text=f"Session Time: {hours:02}:{minutes:02}:{seconds:02}")
-    root.after(1000, update_session_timer)  # keep calling itself every second
-
-# reads serial messages from Arduino and updates GUI in real-time
-def update_serial():
-    while True:
+    global timer_job
+    timer_job = None
+    if not timer_running:
+        return  # session stopped, don't schedule another tick
+    elapsed = int(time.monotonic() - session_start_mono)
+    hours = elapsed // 3600
+    minutes = (elapsed % 3600) // 60
+    seconds = elapsed % 60
+    session_timer_label.config(text=f"Session Time: {hours:02}:{minutes:02}:{seconds:02}")
+    # schedule the next tick for the start of the next whole second so it doesn't drift
+    ms_into_second = int((time.monotonic() - session_start_mono) * 1000) % 1000
+    timer_job = root.after(1000 - ms_into_second, update_session_timer)
+
+# what to queue for each status line the Arduino prints
+# (keys must match the Serial.println text in the Arduino sketch exactly)
+status_messages = {
+    "Fixation Engaged": [("fixation", ("Fixation: ACTIVE", "green")), ("log", "Fixation Engaged")],
+    "Fixation Released": [("fixation", ("Fixation: INACTIVE", "red")), ("log", "Fixation Released")],
+    "Fixation Released due to struggle": [("fixation", ("Fixation: INACTIVE", "red")), ("log", "Fixation Released")],
+    "Escape Event": [("fixation", ("Fixation: ESCAPE", "yellow")), ("log", "Escape Event")],
+    "Time-Up Release": [("fixation", ("Fixation: TIME UP", "purple")), ("log", "Time-Up Release")],
+    "Struggle YES": [("struggle", ("Struggle: YES", "red")), ("log", "Struggle Detected - Released")],
+    "Struggle NO": [("struggle", ("Struggle: NO", "gray"))],
+    "Reward Given": [("log", "Reward Given")],
+}
+
+# handles one complete line received from the Arduino
+# (runs on the serial thread, so it only queues things up for the GUI)
+def parse_line(line):
+    # if we get an event line, parse and queue it for the table
+    # format is EVENT,duration,fix,escape,timeup,struggle,reward
+    if line[:6] == "EVENT,":
+        try:
+            _, d, f, e, tu, st, r = line.split(",", 6)
+            event_q.put(("event", (float(d), int(f), int(e), int(tu), int(st), int(r))))
+        except ValueError:
+            pass  # wrong number of fields or a garbled number, skip this one
+        return
+
+    # status messages from Arduino are matched exactly, one dict lookup per line
+    for msg in status_messages.get(line, ()):
+        event_q.put(msg)
+
+# helpers the GUI thread uses for queued status updates
+def set_fixation_label(payload):
+    text, color = payload
+    fixation_label.config(text=text, fg=color)
+
+def set_struggle_label(payload):
+    text, color = payload
+    struggle_label.config(text=text, fg=color)
+
+# called when the serial reader stops because the Arduino went away
+def serial_disconnected(payload):
+    fixation_label.config(text="Arduino: DISCONNECTED", fg="red")
+    add_console_log("Serial connection lost - check the USB cable and restart")
+
+# what to do with each kind of queued message
+event_handlers = {
+    "event": update_table,
+    "fixation": set_fixation_label,
+    "struggle": set_struggle_label,
+    "log": add_console_log,
+    "disconnected": serial_disconnected,
+}
+
+# empties the event queue on the GUI thread, then checks again in 20 ms
+def drain_events():
+    try:
+        while True:
+            kind, payload = event_q.get_nowait()
+            event_handlers[kind](payload)
+    except queue.Empty:
+        pass
+    finally:
+        root.after(20, drain_events)  # keep polling even if one event failed
+
+# reads serial messages from Arduino on pyserial's reader thread
+# ReaderThread grabs whatever is waiting in the port and LineReader splits it into lines
+class ArduinoProtocol(LineReader):
+    TERMINATOR = b'\n'
+
+    def handle_line(self, line):
+        line = line.strip()
+        if not line:
+            return
         try:
-            line = ser.readline().decode('utf-8', errors='ignore').strip()
-            if not line:
-                continue
-
-            # if we get an event line, parse and update the table
-            if line.startswith("EVENT,"):
-                parts = line.split(",")
-                if len(parts) == 7:
-                    event_data = [
-                        float(parts[1]), int(parts[2]), int(parts[3]),
-                        int(parts[4]), int(parts[5]), int(parts[6])
-                    ]
-                    update_table(event_data)
-
-            # handle various status messages from Arduino
-            if "Fixation Engaged" in line:
-                fixation_label.config(text="Fixation: ACTIVE", fg="green")
-                add_console_log("Fixation Engaged")
-            elif "Fixation Released" in line:
-                fixation_label.config(text="Fixation: INACTIVE", fg="red")
-                add_console_log("Fixation Released")
-            elif "Escape Event" in line:
-                fixation_label.config(text="Fixation: ESCAPE", fg="yellow")
-                add_console_log("Escape Event")
-            elif "Time-Up Release" in line:
-                fixation_label.config(text="Fixation: TIME UP", fg="purple")
-                add_console_log("Time-Up Release")
-
-            if "Struggle YES" in line:
-                struggle_label.config(text="Struggle: YES", fg="red")
-                add_console_log("Struggle Detected - Released")
-            elif "Struggle NO" in line:
-                struggle_label.config(text="Struggle: NO", fg="gray")
-
-            if "Reward Given" in line:
-                add_console_log("Reward Given")
-
-        except:
-            pass  # don't crash if serial reading fails once
+            parse_line(line)
+        except Exception as e:
+            # an exception here would stop the reader thread, so just report it
+            event_q.put(("log", f"Serial error: {e}"))
+
+    def connection_lost(self, exc):
+        # port went away (e.g. cable unplugged) or the reader was stopped
+        # we don't call the base class here: it re-raises exc, which would kill
+        # the thread before the GUI hears about the disconnect
+        if exc is not None:
+            event_q.put(("log", f"Serial error: {exc}"))
+            event_q.put(("disconnected", None))
+        self.transport = None
 
 # starts a session and timer
 def start_session():
-    global session_start_time, timer_running
-    session_start_time = time.time()
+    global session_start_mono, timer_running, timer_job
+    session_start_mono = time.monotonic()
     timer_running = True
-    ser.write(b'b')  # tell Arduino session started
+    if timer_job is not None:
+        root.after_cancel(timer_job)  # restarting, drop the old tick
+    update_session_timer()
+    send_command(b'b')  # tell Arduino session started
     add_console_log(f"Session Started for {rat_name_entry.get()}")
 
 # stops session (but does not clear totals)
 def stop_session():
     global timer_running
     timer_running = False
-    ser.write(b'c')  # tell Arduino session stopped
+    send_command(b'c')  # tell Arduino session stopped
     add_console_log("Session Stopped")
 
-# runs the serial listener in the background
-def start_serial_thread():
-    threading.Thread(target=update_serial, daemon=True).start()
+# stops the serial listener cleanly before closing the window
+def on_close():
+    reader.stop()
+    root.destroy()
 
 
 # === GUI BUILDING STARTS HERE ===
@@ -249,18 +371,18 @@ reward_buffer_entry = make_param_row(param_frame, "Reward Buffer (ms):", reward_
 flush_button = tk.Button(root, text="Flush Water", width=20, bg="#2196F3", fg="white", command=toggle_flush)
 flush_button.grid(row=8, column=0, columnspan=2, pady=5)
 
-free_reward_var = tk.BooleanVar(value=True)
+free_reward_var = tk.BooleanVar(value=True)    # whether free rewards are allowed
 free_reward_check = tk.Checkbutton(root, text="Allow Free Rewards", variable=free_reward_var,
                                    command=toggle_free_reward, bg="#f2f2f2")
 free_reward_check.grid(row=9, column=0, columnspan=2, pady=5)
 
-habituation_var = tk.BooleanVar(value=False)
+habituation_var = tk.BooleanVar(value=False)   # whether habituation mode is turned on
 habituation_check = tk.Checkbutton(root, text="Habituation Mode", variable=habituation_var,
                                    command=toggle_habituation, bg="#f2f2f2")
 habituation_check.grid(row=10, column=0, columnspan=2, pady=5)
 
 emergency_button = tk.Button(root, text="EMERGENCY RELEASE", bg="red", fg="white", width=20,
-                             command=lambda: ser.write(b'j'))
+                             command=lambda: send_command(b'j'))
 emergency_button.grid(row=11, column=0, columnspan=2, pady=5)
 
 # --- Spout movement buttons ---
@@ -311,35 +433,38 @@ columns = ["Time(s)", "Fix", "Escape", "TimeUp", "Struggle", "Reward"]
 table_frame = tk.LabelFrame(root, text="Trial Data", bg="#f2f2f2", font=("Arial", 10, "bold"))
 table_frame.grid(row=7, column=3, rowspan=4, padx=10, pady=5)
 
-table_labels = []
-for r in range(3):
-    row_labels = []
-    for c in range(len(columns)):
-        text = columns[c] if r == 0 else "0"
-        lbl = tk.Label(table_frame, text=text, width=10, relief=tk.GROOVE, bg="#ffffff")
+# header row, then a totals row and a most-recent-trial row, each keyed by column name
+table_labels = {"totals": {}, "current": {}}
+for c, (key, header) in enumerate(zip(column_keys, columns)):
+    tk.Label(table_frame, text=header, width=10, relief=tk.GROOVE, bg="#ffffff").grid(row=0, column=c)
+    for r, row_name in enumerate(("totals", "current"), start=1):
+        lbl = tk.Label(table_frame, text="0", width=10, relief=tk.GROOVE, bg="#ffffff")
         lbl.grid(row=r, column=c)
-        row_labels.append(lbl)
-    table_labels.append(row_labels)
+        table_labels[row_name][key] = lbl
 
 def reset_table():
-    for r in range(1, 3):
-        for c in range(len(columns)):
-            table_labels[r][c].config(text="0")
+    for row in table_labels.values():
+        for lbl in row.values():
+            lbl.config(text="0")
     for k in totals: totals[k] = 0
+    for k in shown_totals: shown_totals[k] = "0"
+    trial_log.clear()
 
 # --- Actuator level buttons ---
 level_frame = tk.LabelFrame(root, text="Actuator Levels", bg="#f2f2f2", font=("Arial", 10, "bold"))
 level_frame.grid(row=12, column=3, padx=10, pady=10)
 
 def send_level(level):
-    ser.write(f"L{level}\n".encode())
+    send_command(f"L{level}\n".encode())
     add_console_log(f"Actuator Level {level} Selected")
 
 for i in range(1, 6):
     tk.Button(level_frame, text=f"Level {i}", width=10, bg="#607D8B", fg="white",
               command=lambda i=i: send_level(i)).grid(row=0, column=i-1, padx=3, pady=3)
 
-# start serial listener and timer update loop
-start_serial_thread()
-update_session_timer()
+# start serial listener and GUI event loop for it (timer starts with the session)
+reader = ReaderThread(ser, ArduinoProtocol)
+reader.start()
+root.protocol("WM_DELETE_WINDOW", on_close)
+drain_events()
 root.mainloop()